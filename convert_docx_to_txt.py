@@ -4,23 +4,38 @@
 Сохраняет правильную последовательность текста и изображений.
 """
 
+import io
 import os
+import json
 import re
 import sys
+import time
 import base64
+import random
+import hashlib
+import tempfile
 import zipfile
-import xml.etree.ElementTree as ET
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 try:
-    from docx import Document
-    from docx.document import Document as DocumentType
-    HAS_DOCX = True
+    from PIL import Image
+    HAS_PIL = True
 except ImportError:
-    HAS_DOCX = False
-    print("Предупреждение: python-docx не установлен. Будет использован базовый парсинг XML.")
+    HAS_PIL = False
+    print("Предупреждение: Pillow не установлен. Изображения будут отправляться без сжатия.")
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -28,50 +43,285 @@ load_dotenv()
 OPENROUTER_API_KEY = os.getenv("LLM_TOKEN", "").strip('"')
 VISION_MODEL = os.getenv("VISION_MODEL", "google/gemini-2.0-flash-001")
 OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+# Количество параллельных запросов к API при анализе изображений
+IMAGE_WORKERS = max(1, int(os.getenv("IMAGE_WORKERS", "8")))
+# Количество DOCX файлов, обрабатываемых параллельно в отдельных процессах.
+# Одновременных запросов к API будет до FILE_WORKERS * IMAGE_WORKERS, поэтому по умолчанию немного
+FILE_WORKERS = max(1, int(os.getenv("FILE_WORKERS", "2")))
+# Максимальная случайная задержка (сек) перед первым запросом каждого потока
+IMAGE_STAGGER = float(os.getenv("IMAGE_STAGGER", "0.1"))
+
+# MIME типы изображений по расширению файла (по умолчанию используется image/png)
+MIME_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp'
+}
+
+# Изображения больше этого размера (px по длинной стороне) уменьшаются перед отправкой
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1568"))
+# Файлы меньше этого размера (байт) не пережимаются, если не превышают IMAGE_MAX_SIDE
+IMAGE_RECOMPRESS_BYTES = 256 * 1024
+# Для мелких изображений достаточно низкой детализации, это экономит токены
+IMAGE_LOW_DETAIL_SIDE = 512
+
+# Необязательное хранилище для крупных изображений: файл загружается PUT-запросом,
+# а в API передается публичная ссылка вместо base64 (провайдер скачивает его сам)
+IMAGE_UPLOAD_URL = os.getenv("IMAGE_UPLOAD_URL", "").rstrip('/')
+IMAGE_PUBLIC_URL = os.getenv("IMAGE_PUBLIC_URL", IMAGE_UPLOAD_URL).rstrip('/')
+IMAGE_UPLOAD_TOKEN = os.getenv("IMAGE_UPLOAD_TOKEN", "")
+# Изображения меньше этого размера (байт) всегда передаются как data URL
+IMAGE_INLINE_BYTES = 256 * 1024
+
+# Кэш описаний изображений по SHA-256 содержимого (пустое значение отключает диск)
+VISION_CACHE_DIR = os.path.expanduser(os.getenv("VISION_CACHE_DIR", "~/.cache/docx2txt/vision"))
+# Срок жизни записей дискового кэша в днях (0 - без ограничения)
+VISION_CACHE_TTL = float(os.getenv("VISION_CACHE_TTL", "0"))
+# Максимальный размер дискового кэша в мегабайтах (0 - без ограничения), старые записи удаляются первыми
+VISION_CACHE_MAX_MB = float(os.getenv("VISION_CACHE_MAX_MB", "0"))
+
+# Коды ответа, при которых запрос к API стоит повторить
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Сколько раз повторять запрос к API (всего попыток - на одну больше)
+VISION_RETRIES = max(0, int(os.getenv("VISION_RETRIES", "3")))
+
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://github.com",  # Опционально, для отслеживания
+}
+
+# Общая сессия: TCP/TLS соединения с OpenRouter переиспользуются всеми потоками,
+# а временные ошибки (429, 5xx) и сбои подключения повторяются с экспоненциальной задержкой.
+# После таймаута чтения POST не повторяется: сервер мог уже выполнить и оплатить запрос.
+# Такое изображение в текущем запуске остается с текстом ошибки, а файл обрабатывается
+# заново при следующем запуске (TXT без маркера завершения не считается готовым).
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_maxsize=IMAGE_WORKERS,
+    max_retries=Retry(
+        total=VISION_RETRIES,
+        connect=VISION_RETRIES,
+        read=0,
+        status=VISION_RETRIES,
+        backoff_factor=2,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['POST']),
+    ),
+))
+
+# Пространства имен DOCX и производные от них имена элементов в нотации {namespace}tag
+NS = {
+    'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+}
+RELS_NS = {'r': 'http://schemas.openxmlformats.org/package/2006/relationships'}
 
+PARAGRAPH_TAG = f"{{{NS['w']}}}p"
+TEXT_TAG = f"{{{NS['w']}}}t"
+BLIP_TAG = f"{{{NS['a']}}}blip"
+EMBED_ATTR = f"{{{NS['r']}}}embed"
+RELATIONSHIP_XPATH = etree.XPath('.//r:Relationship', namespaces=RELS_NS)
 
-def extract_images_from_docx(docx_path: str) -> dict:
-    """Извлекает все изображения из DOCX файла."""
+# Префикс строк вывода: при параллельной обработке помечает, к какому файлу они относятся
+_log_prefix = ''
+
+
+def log(message: str) -> None:
+    """Печатает сообщение о ходе обработки с префиксом текущего файла."""
+    # Одна запись вместе с переводом строки, чтобы строки разных процессов не склеивались
+    print(f"{_log_prefix}{message}\n", end='', flush=True)
+
+
+def extract_images_from_docx(zip_ref: zipfile.ZipFile) -> Dict[str, zipfile.ZipInfo]:
+    """
+    Находит все изображения в открытом архиве DOCX.
+    Возвращает только записи архива: байты читаются позже и лишь для используемых изображений.
+    """
     images = {}
-    with zipfile.ZipFile(docx_path, 'r') as zip_ref:
-        for file_info in zip_ref.namelist():
-            if file_info.startswith('word/media/'):
-                images[file_info] = zip_ref.read(file_info)
+    for file_info in zip_ref.infolist():
+        if file_info.filename.startswith('word/media/'):
+            images[file_info.filename] = file_info
     return images
 
 
+_memory_cache: Dict[str, str] = {}
+# Блокировки по хэшу: одинаковые изображения, попавшие в пул одновременно, анализируются один раз
+_hash_locks: Dict[str, threading.Lock] = {}
+_hash_locks_guard = threading.Lock()
+
+
+def prune_vision_cache() -> None:
+    """Удаляет из дискового кэша просроченные записи и самые старые, если превышен VISION_CACHE_MAX_MB."""
+    if not VISION_CACHE_DIR or (VISION_CACHE_TTL <= 0 and VISION_CACHE_MAX_MB <= 0):
+        return
+    
+    entries = []
+    now = time.time()
+    for cache_file in Path(VISION_CACHE_DIR).glob('*.txt'):
+        try:
+            stat = cache_file.stat()
+            if VISION_CACHE_TTL > 0 and now - stat.st_mtime > VISION_CACHE_TTL * 86400:
+                cache_file.unlink()
+                continue
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+    
+    if VISION_CACHE_MAX_MB <= 0:
+        return
+    total_size = sum(size for _, size, _ in entries)
+    max_size = VISION_CACHE_MAX_MB * 1024 * 1024
+    for _, size, cache_file in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            cache_file.unlink()
+        except OSError:
+            continue
+        total_size -= size
+
+
+def get_cached_description(image_hash: str):
+    """Возвращает сохраненное описание изображения или None."""
+    if image_hash in _memory_cache:
+        return _memory_cache[image_hash]
+    if not VISION_CACHE_DIR:
+        return None
+    
+    cache_file = Path(VISION_CACHE_DIR) / f"{image_hash}.txt"
+    try:
+        if VISION_CACHE_TTL > 0 and time.time() - cache_file.stat().st_mtime > VISION_CACHE_TTL * 86400:
+            return None
+        description = cache_file.read_text(encoding='utf-8')
+    except OSError:
+        return None
+    
+    _memory_cache[image_hash] = description
+    return description
+
+
+def save_cached_description(image_hash: str, description: str) -> None:
+    """Сохраняет описание изображения в памяти и атомарно записывает его на диск."""
+    _memory_cache[image_hash] = description
+    if not VISION_CACHE_DIR:
+        return
+    
+    try:
+        os.makedirs(VISION_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=VISION_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(description)
+        os.replace(tmp_path, os.path.join(VISION_CACHE_DIR, f"{image_hash}.txt"))
+    except OSError as e:
+        log(f"  Предупреждение: не удалось записать кэш изображения: {e}")
+
+
+def preprocess_image(image_data: bytes, mime_type: str) -> Tuple[bytes, str, str]:
+    """
+    Уменьшает большие изображения и пережимает их в JPEG перед отправкой в API.
+    Возвращает (данные изображения, MIME тип, уровень детализации для API).
+    """
+    if not HAS_PIL:
+        return image_data, mime_type, 'auto'
+    
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            longest_side = max(img.size)
+            detail = 'low' if longest_side <= IMAGE_LOW_DETAIL_SIDE else 'auto'
+            if len(image_data) <= IMAGE_RECOMPRESS_BYTES and longest_side <= IMAGE_MAX_SIDE:
+                return image_data, mime_type, detail
+            
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+            # Прозрачный фон заливаем белым, иначе в JPEG он станет черным
+            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                rgba = img.convert('RGBA')
+                rgb = Image.new('RGB', rgba.size, (255, 255, 255))
+                rgb.paste(rgba, mask=rgba.getchannel('A'))
+            else:
+                rgb = img.convert('RGB')
+            
+            buffer = io.BytesIO()
+            rgb.save(buffer, 'JPEG', quality=85, optimize=True)
+    except Exception:
+        # Форматы, которые Pillow не читает (например, EMF/WMF), отправляем как есть
+        return image_data, mime_type, 'auto'
+    
+    if buffer.tell() >= len(image_data):
+        return image_data, mime_type, detail
+    return buffer.getvalue(), 'image/jpeg', detail
+
+
 def get_image_base64(image_data: bytes) -> str:
     """Конвертирует изображение в base64 строку."""
     return base64.b64encode(image_data).decode('utf-8')
 
 
-def analyze_image_with_api(image_data: bytes, image_name: str) -> str:
-    """Отправляет изображение в OpenRouter API для анализа."""
+def to_image_ref(image_data: bytes, mime_type: str) -> str:
+    """
+    Возвращает ссылку на изображение для запроса к API.
+    Крупные файлы загружаются в IMAGE_UPLOAD_URL (если он задан), остальные передаются как data URL.
+    """
+    if IMAGE_UPLOAD_URL and len(image_data) >= IMAGE_INLINE_BYTES:
+        # Имя по содержимому: повторная загрузка того же изображения перезапишет тот же объект
+        object_name = f"{hashlib.sha256(image_data).hexdigest()}.{mime_type.split('/')[-1]}"
+        headers = {"Content-Type": mime_type}
+        if IMAGE_UPLOAD_TOKEN:
+            headers["Authorization"] = f"Bearer {IMAGE_UPLOAD_TOKEN}"
+        try:
+            response = _session.put(f"{IMAGE_UPLOAD_URL}/{object_name}", headers=headers, data=image_data, timeout=60)
+            response.raise_for_status()
+            return f"{IMAGE_PUBLIC_URL}/{object_name}"
+        except requests.RequestException as e:
+            log(f"  Предупреждение: не удалось загрузить изображение, используется base64: {e}")
+    
+    return f"data:{mime_type};base64,{get_image_base64(image_data)}"
+
+
+def dump_payload(payload: dict) -> bytes:
+    """Сериализует тело запроса в JSON; orjson заметно быстрее на длинных base64 строках."""
+    if HAS_ORJSON:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def analyze_image_with_api(image_data: bytes, image_name: str) -> Tuple[str, bool]:
+    """
+    Возвращает описание изображения из кэша или запрашивает его у OpenRouter API.
+    Возвращает (текст, успешно ли): при ошибке текст описывает ее и не кэшируется.
+    """
+    # Одинаковые изображения (логотипы, повторные запуски) берем из кэша
+    image_hash = hashlib.sha256(VISION_MODEL.encode('utf-8') + b'\0' + image_data).hexdigest()
+    with _hash_locks_guard:
+        hash_lock = _hash_locks.setdefault(image_hash, threading.Lock())
+    
+    # Пока один поток анализирует изображение, его копии ждут и берут результат из кэша
+    with hash_lock:
+        cached = get_cached_description(image_hash)
+        if cached is not None:
+            return cached, True
+        return request_image_description(image_data, image_name, image_hash)
+
+
+def request_image_description(image_data: bytes, image_name: str, image_hash: str) -> Tuple[str, bool]:
+    """Отправляет изображение в OpenRouter API для анализа и кэширует успешный ответ."""
     if not OPENROUTER_API_KEY:
-        return f"[Изображение: {image_name} - API токен не найден]"
+        return f"[Изображение: {image_name} - API токен не найден]", False
     
     try:
-        # Конвертируем в base64
-        image_base64 = get_image_base64(image_data)
-        
         # Определяем MIME тип по расширению
-        ext = Path(image_name).suffix.lower()
-        mime_types = {
-            '.png': 'image/png',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.gif': 'image/gif',
-            '.webp': 'image/webp'
-        }
-        mime_type = mime_types.get(ext, 'image/png')
+        dot = image_name.rfind('.')
+        ext = image_name[dot:].lower() if dot >= 0 else ''
+        mime_type = MIME_TYPES.get(ext, 'image/png')
         
-        # Формируем запрос к OpenRouter API
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com",  # Опционально, для отслеживания
-        }
+        # Уменьшаем изображение и получаем ссылку на него (URL хранилища или base64)
+        image_data, mime_type, detail = preprocess_image(image_data, mime_type)
+        image_url = to_image_ref(image_data, mime_type)
         
+        # Формируем запрос к OpenRouter API
         payload = {
             "model": VISION_MODEL,
             "messages": [
@@ -85,7 +335,8 @@ def analyze_image_with_api(image_data: bytes, image_name: str) -> str:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:{mime_type};base64,{image_base64}"
+                                "url": image_url,
+                                "detail": detail
                             }
                         }
                     ]
@@ -94,200 +345,266 @@ def analyze_image_with_api(image_data: bytes, image_name: str) -> str:
             "max_tokens": 4000
         }
         
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=60)
+        response = _session.post(OPENROUTER_API_URL, headers=OPENROUTER_HEADERS, data=dump_payload(payload), timeout=60)
         response.raise_for_status()
         
         result = response.json()
         if 'choices' in result and len(result['choices']) > 0:
-            return result['choices'][0]['message']['content']
+            description = result['choices'][0]['message']['content']
+            save_cached_description(image_hash, description)
+            return description, True
         else:
-            return f"[Изображение: {image_name} - Не удалось получить описание]"
+            return f"[Изображение: {image_name} - Не удалось получить описание]", False
             
     except Exception as e:
-        return f"[Изображение: {image_name} - Ошибка анализа: {str(e)}]"
+        return f"[Изображение: {image_name} - Ошибка анализа: {str(e)}]", False
 
 
-def parse_docx_structure(docx_path: str) -> Tuple[List[Tuple[str, str]], Dict[str, bytes]]:
+_worker_state = threading.local()
+
+
+def analyze_image_staggered(zip_ref: zipfile.ZipFile, image_info: zipfile.ZipInfo, image_name: str) -> Tuple[str, bool]:
     """
-    Парсит DOCX файл и возвращает список элементов (текст или изображение) в правильном порядке.
-    Возвращает (список кортежей: ('text', content) или ('image', image_path_in_zip), словарь изображений)
+    Читает изображение из архива и анализирует его, сдвигая первый запрос каждого потока
+    на случайную паузу. Так потоки не кодируют и не отправляют данные одновременно.
     """
-    elements = []
-    images = extract_images_from_docx(docx_path)
+    if not getattr(_worker_state, 'started', False):
+        _worker_state.started = True
+        time.sleep(random.uniform(0, IMAGE_STAGGER))
+    return analyze_image_with_api(zip_ref.read(image_info), image_name)
+
+
+def iter_paragraphs(document_xml: bytes):
+    """
+    Потоково перебирает параграфы верхнего уровня document.xml в порядке их появления.
+    Вложенные параграфы (надписи, text box) обходятся вместе с внешним параграфом.
+    Обработанные узлы сразу освобождаются, поэтому дерево целиком в памяти не строится.
+    """
+    # Внешние сущности не раскрываем: иначе DOCX мог бы подставить в TXT локальные файлы
+    for _, paragraph in etree.iterparse(io.BytesIO(document_xml), events=('end',), tag=PARAGRAPH_TAG,
+                                        resolve_entities=False, no_network=True):
+        if next(paragraph.iterancestors(PARAGRAPH_TAG), None) is not None:
+            continue
+        yield paragraph
+        paragraph.clear()
+        while paragraph.getprevious() is not None:
+            del paragraph.getparent()[0]
+
+
+def read_image_relationships(zip_ref: zipfile.ZipFile) -> Dict[str, str]:
+    """Читает relationships документа: ID связи -> путь изображения внутри архива."""
+    try:
+        rels_xml = zip_ref.read('word/_rels/document.xml.rels')
+        parser = etree.XMLParser(resolve_entities=False, no_network=True)
+        rels_root = etree.fromstring(rels_xml, parser)
+    except (KeyError, etree.XMLSyntaxError):
+        return {}
     
-    if HAS_DOCX:
-        # Используем python-docx для более надежного парсинга
-        try:
-            doc = Document(docx_path)
-            
-            with zipfile.ZipFile(docx_path, 'r') as zip_ref:
-                # Читаем relationships для связи ID изображений с путями
-                rels_xml = zip_ref.read('word/_rels/document.xml.rels')
-                rels_root = ET.fromstring(rels_xml)
-                rels_ns = {'r': 'http://schemas.openxmlformats.org/package/2006/relationships'}
-                
-                rel_to_image = {}
-                for rel in rels_root.findall('.//r:Relationship', rels_ns):
-                    target = rel.get('Target', '')
-                    if target.startswith('media/'):
-                        rel_to_image[rel.get('Id')] = f'word/{target}'
-                
-                # Парсим XML напрямую для поиска изображений в правильном порядке
-                document_xml = zip_ref.read('word/document.xml')
-                root = ET.fromstring(document_xml)
-                ns = {
-                    'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
-                    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
-                    'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
-                    'pic': 'http://schemas.openxmlformats.org/drawingml/2006/picture'
-                }
-                
-                # Обрабатываем все параграфы в порядке их появления
-                for paragraph in root.findall('.//w:p', ns):
-                    # Извлекаем весь текст параграфа
-                    text_parts = []
-                    for t in paragraph.findall('.//w:t', ns):
-                        if t.text:
-                            text_parts.append(t.text)
-                    
-                    # Проверяем наличие рисунков в параграфе
-                    drawings = paragraph.findall('.//w:drawing', ns)
-                    image_found = False
-                    
-                    if drawings:
-                        for drawing in drawings:
-                            # Ищем blip (изображение)
-                            blip = drawing.find('.//a:blip', ns)
-                            if blip is not None:
-                                r_embed = blip.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                                if r_embed and r_embed in rel_to_image:
-                                    image_path = rel_to_image[r_embed]
-                                    if image_path in images:
-                                        # Добавляем текст перед изображением, если есть
-                                        if text_parts:
-                                            text_content = ''.join(text_parts).strip()
-                                            if text_content:
-                                                elements.append(('text', text_content))
-                                        elements.append(('image', image_path))
-                                        image_found = True
-                                        text_parts = []  # Очищаем, так как уже добавили
-                                        break
-                    
-                    # Добавляем текст, если изображение не найдено или текст остался
-                    if not image_found and text_parts:
-                        text_content = ''.join(text_parts).strip()
-                        if text_content:
-                            elements.append(('text', text_content))
-            
-            return elements, images
-        except Exception as e:
-            print(f"  Предупреждение: ошибка при использовании python-docx: {e}")
-            print("  Переключение на базовый XML парсинг...")
+    rel_to_image = {}
+    for rel in RELATIONSHIP_XPATH(rels_root):
+        target = rel.get('Target', '')
+        if target.startswith('media/'):
+            rel_to_image[rel.get('Id')] = f'word/{target}'
+    return rel_to_image
+
+
+def append_text(elements: List[Tuple[str, str]], text_parts: List[str]) -> None:
+    """Добавляет накопленный текст как отдельный элемент, если он не пустой."""
+    text_content = ''.join(text_parts).strip()
+    if text_content:
+        elements.append(('text', text_content))
+    text_parts.clear()
+
+
+def parse_document_xml(zip_ref: zipfile.ZipFile, images: Dict[str, zipfile.ZipInfo]) -> List[Tuple[str, str]]:
+    """
+    Обходит параграфы document.xml и возвращает текст и изображения в порядке их появления.
+    Текст до и после рисунка или вложенного параграфа становится отдельными элементами.
+    """
+    rel_to_image = read_image_relationships(zip_ref)
+    document_xml = zip_ref.read('word/document.xml')
     
-    # Базовый XML парсинг (fallback)
-    with zipfile.ZipFile(docx_path, 'r') as zip_ref:
-        document_xml = zip_ref.read('word/document.xml')
-        root = ET.fromstring(document_xml)
-        
-        ns = {
-            'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main',
-            'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
-            'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
-        }
-        
-        # Читаем relationships
-        try:
-            rels_xml = zip_ref.read('word/_rels/document.xml.rels')
-            rels_root = ET.fromstring(rels_xml)
-            rels_ns = {'r': 'http://schemas.openxmlformats.org/package/2006/relationships'}
-            
-            rel_to_image = {}
-            for rel in rels_root.findall('.//r:Relationship', rels_ns):
-                target = rel.get('Target', '')
-                if target.startswith('media/'):
-                    rel_to_image[rel.get('Id')] = f'word/{target}'
-        except:
-            rel_to_image = {}
-        
-        # Обрабатываем параграфы
-        for paragraph in root.findall('.//w:p', ns):
-            text_parts = []
-            for t in paragraph.findall('.//w:t', ns):
-                if t.text:
-                    text_parts.append(t.text)
-            
-            drawings = paragraph.findall('.//w:drawing', ns)
-            image_found = False
-            
-            if drawings:
-                for drawing in drawings:
-                    blip = drawing.find('.//a:blip', ns)
-                    if blip is not None:
-                        r_embed = blip.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                        if r_embed and r_embed in rel_to_image:
-                            image_path = rel_to_image[r_embed]
-                            if image_path in images:
-                                if text_parts:
-                                    text_content = ''.join(text_parts).strip()
-                                    if text_content:
-                                        elements.append(('text', text_content))
-                                elements.append(('image', image_path))
-                                image_found = True
-                                text_parts = []
-                                break
+    elements = []
+    for paragraph in iter_paragraphs(document_xml):
+        text_parts = []
+        walk = etree.iterwalk(paragraph, events=('start', 'end'), tag=(PARAGRAPH_TAG, TEXT_TAG, BLIP_TAG))
+        for event, node in walk:
+            if node.tag == PARAGRAPH_TAG:
+                # Границы параграфов (в том числе вложенных) разделяют текст
+                append_text(elements, text_parts)
+                continue
+            if event == 'end':
+                continue
+            if node.tag == TEXT_TAG:
+                if node.text:
+                    text_parts.append(node.text)
+                continue
             
-            if not image_found and text_parts:
-                text_content = ''.join(text_parts).strip()
-                if text_content:
-                    elements.append(('text', text_content))
+            image_path = rel_to_image.get(node.get(EMBED_ATTR))
+            if image_path in images:
+                # Текст перед изображением идет отдельным элементом
+                append_text(elements, text_parts)
+                elements.append(('image', image_path))
     
+    return elements
+
+
+def parse_docx_structure(zip_ref: zipfile.ZipFile) -> Tuple[List[Tuple[str, str]], Dict[str, zipfile.ZipInfo]]:
+    """
+    Парсит открытый DOCX архив и возвращает список элементов (текст или изображение) в правильном порядке.
+    Возвращает (список кортежей: ('text', content) или ('image', image_path_in_zip), словарь записей изображений)
+    """
+    images = extract_images_from_docx(zip_ref)
+    elements = parse_document_xml(zip_ref, images)
     return elements, images
 
 
-def convert_docx_to_txt(docx_path: str, output_path: str = None) -> str:
-    """Конвертирует DOCX файл в TXT с анализом изображений."""
+# Последняя строка TXT, созданного скриптом: хэш исходного DOCX показывает, актуален ли файл
+COMPLETION_MARKER = "# done: "
+
+
+def file_sha256(path: str) -> str:
+    """Считает SHA-256 файла, читая его блоками."""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def read_completion_marker(txt_file: Path) -> Optional[str]:
+    """Возвращает хэш DOCX из последней строки TXT или None, если маркера нет."""
+    try:
+        with open(txt_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256))
+            tail = f.read().decode('utf-8', errors='ignore')
+    except OSError:
+        return None
+    last_line = tail.rstrip('\n').rsplit('\n', 1)[-1]
+    if not last_line.startswith(COMPLETION_MARKER):
+        return None
+    return last_line[len(COMPLETION_MARKER):]
+
+
+def needs_processing(docx_file: Path) -> Tuple[bool, str, Optional[str]]:
+    """
+    Решает, нужно ли обрабатывать DOCX. Возвращает (нужно ли, сообщение для вывода, хэш DOCX или None).
+    Посчитанный хэш передается дальше в convert_docx_to_txt, чтобы не читать файл дважды.
+    TXT без маркера (созданный вручную или старой версией скрипта) никогда не перезаписывается.
+    """
+    txt_file = docx_file.with_suffix('.txt')
+    try:
+        if not txt_file.exists():
+            return True, '', None
+        
+        marker_hash = read_completion_marker(txt_file)
+        if marker_hash is None:
+            return False, (f"Пропуск {docx_file.name} - файл {txt_file.name} уже существует "
+                           f"(без отметки о завершении; удалите его, чтобы создать заново)."), None
+        docx_hash = file_sha256(str(docx_file))
+    except OSError as e:
+        return False, f"ОШИБКА при проверке {docx_file}: {str(e)}", None
+    
+    if marker_hash == docx_hash:
+        return False, f"Пропуск {docx_file.name} - файл {txt_file.name} уже существует.", None
+    return True, f"Файл {docx_file.name} изменился с прошлой обработки - {txt_file.name} будет пересоздан.", docx_hash
+
+
+def convert_docx_to_txt(docx_path: str, output_path: str = None, docx_hash: Optional[str] = None) -> str:
+    """
+    Конвертирует DOCX файл в TXT с анализом изображений.
+    docx_hash - уже посчитанный SHA-256 файла (если None, считается здесь).
+    """
     if output_path is None:
         output_path = str(Path(docx_path).with_suffix('.txt'))
     
-    print(f"Обработка: {docx_path}")
-    
-    # Парсим структуру документа
-    elements, images = parse_docx_structure(docx_path)
-    
-    if not elements:
-        print(f"  Предупреждение: не удалось извлечь содержимое из {docx_path}")
-        return output_path
-    
-    # Формируем итоговый текст
-    result_lines = []
-    image_count = 0
+    log(f"Обработка: {docx_path}")
+    if docx_hash is None:
+        docx_hash = file_sha256(docx_path)
     
-    for element_type, content in elements:
-        if element_type == 'text':
-            result_lines.append(content)
-            result_lines.append('')  # Пустая строка после текста
-        elif element_type == 'image':
-            image_count += 1
-            image_name = Path(content).name
-            print(f"  Анализ изображения {image_count}: {image_name}")
-            
-            if content in images:
-                image_description = analyze_image_with_api(images[content], image_name)
-                result_lines.append(f"\n[ИЗОБРАЖЕНИЕ {image_count}: {image_name}]")
-                result_lines.append(image_description)
-                result_lines.append('')  # Пустая строка после описания
-            else:
-                result_lines.append(f"\n[ИЗОБРАЖЕНИЕ {image_count}: {image_name} - не найдено]")
-                result_lines.append('')
-    
-    # Сохраняем результат
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(result_lines))
+    # Архив открываем один раз и держим открытым, пока потоки читают из него изображения
+    with zipfile.ZipFile(docx_path, 'r') as zip_ref:
+        # Парсим структуру документа
+        elements, images = parse_docx_structure(zip_ref)
+        
+        if not elements:
+            log(f"  Предупреждение: не удалось извлечь содержимое из {docx_path}")
+            return output_path
+        
+        # Запускаем анализ изображений параллельно; повторно вставленная картинка анализируется один раз
+        image_paths = [content for element_type, content in elements if element_type == 'image']
+        unique_paths = [path for path in dict.fromkeys(image_paths) if path in images]
+        
+        # Пишем во временный файл и подменяем им TXT только в конце: недописанный результат не остается
+        part_path = f"{output_path}.part"
+        executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS)
+        try:
+            with open(part_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                futures = {
+                    path: executor.submit(analyze_image_staggered, zip_ref, images[path], Path(path).name)
+                    for path in unique_paths
+                }
+                
+                # Пишем результат сразу в исходном порядке, дожидаясь только очередного изображения
+                image_count = 0
+                failed_count = 0
+                for element_type, content in elements:
+                    if element_type == 'text':
+                        f.write(content + '\n\n')
+                    elif element_type == 'image':
+                        image_count += 1
+                        image_name = Path(content).name
+                        
+                        if content in futures:
+                            log(f"  Анализ изображения {image_count}/{len(image_paths)}: {image_name}")
+                            image_description, ok = futures[content].result()
+                            if not ok:
+                                failed_count += 1
+                            f.write(f"\n[ИЗОБРАЖЕНИЕ {image_count}: {image_name}]\n{image_description}\n\n")
+                        else:
+                            f.write(f"\n[ИЗОБРАЖЕНИЕ {image_count}: {image_name} - не найдено]\n\n")
+                
+                # Маркер с хэшем DOCX: по нему следующий запуск узнает, актуален ли TXT.
+                # Если какие-то изображения не проанализированы, маркер не пишем
+                if not failed_count:
+                    f.write(f"{COMPLETION_MARKER}{docx_hash}\n")
+        except BaseException:
+            # При ошибке или Ctrl-C не ждем оставшиеся в очереди запросы к API
+            executor.shutdown(wait=False, cancel_futures=True)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        executor.shutdown()
+        
+        # С ошибками анализа результат остается в .part: следующий запуск обработает файл заново,
+        # а уже полученные описания возьмет из кэша
+        if failed_count:
+            log(f"  Предупреждение: не удалось проанализировать {failed_count} изображений. "
+                f"Результат сохранен в {part_path}, запустите скрипт повторно.")
+            return output_path
+        os.replace(part_path, output_path)
     
-    print(f"  Готово: {output_path} ({image_count} изображений обработано)")
+    log(f"  Готово: {output_path} ({image_count} изображений обработано)")
     return output_path
 
 
+def process_one(docx_file: str, docx_hash: Optional[str] = None, tag_logs: bool = False) -> None:
+    """
+    Обрабатывает один DOCX файл. Вынесено на уровень модуля для ProcessPoolExecutor.
+    При tag_logs строки вывода помечаются именем файла, чтобы вывод процессов не перемешивался.
+    """
+    global _log_prefix
+    _log_prefix = f"[{Path(docx_file).name}] " if tag_logs else ''
+    
+    try:
+        convert_docx_to_txt(docx_file, docx_hash=docx_hash)
+    except Exception as e:
+        log(f"ОШИБКА при обработке {docx_file}: {str(e)}")
+    if not tag_logs:
+        print()
+
+
 def main():
     """Основная функция."""
     # Обрабатываем аргументы командной строки
@@ -328,26 +645,41 @@ def main():
     
     print(f"Найдено {len(docx_files)} DOCX файлов для обработки.\n")
     
+    # Заранее отбрасываем уже обработанные файлы; хэши DOCX считаем параллельно
+    with ThreadPoolExecutor(max_workers=FILE_WORKERS) as executor:
+        decisions = list(executor.map(needs_processing, docx_files))
+    
+    todo = []
+    for docx_file, (is_pending, message, docx_hash) in zip(docx_files, decisions):
+        if is_pending:
+            todo.append((str(docx_file), docx_hash))
+        if message:
+            print(message)
+    
+    if not todo:
+        print("\nВсе файлы уже обработаны.")
+        return
+    if any(message for _, message, _ in decisions):
+        print()
+    
     # Проверяем наличие токена
     if not OPENROUTER_API_KEY:
         print("ОШИБКА: LLM_TOKEN не найден в .env файле!")
         return
     
     print(f"Используется модель: {VISION_MODEL}\n")
+    prune_vision_cache()
     
-    # Обрабатываем каждый файл
-    for docx_file in docx_files:
-        # Пропускаем файлы, для которых уже существует .txt файл
-        txt_file = docx_file.with_suffix('.txt')
-        if txt_file.exists():
-            print(f"Пропуск {docx_file.name} - файл {txt_file.name} уже существует.\n")
-            continue
-        
-        try:
-            convert_docx_to_txt(str(docx_file))
-            print()
-        except Exception as e:
-            print(f"ОШИБКА при обработке {docx_file}: {str(e)}\n")
+    # Файлы независимы, поэтому обрабатываем их параллельно в отдельных процессах
+    file_workers = min(FILE_WORKERS, len(todo))
+    if file_workers == 1:
+        for docx_file, docx_hash in todo:
+            process_one(docx_file, docx_hash)
+    else:
+        with ProcessPoolExecutor(max_workers=file_workers) as executor:
+            docx_paths, docx_hashes = zip(*todo)
+            for _ in executor.map(process_one, docx_paths, docx_hashes, repeat(True)):
+                pass
     
     print("Обработка завершена!")
 